@@ -3,27 +3,83 @@
 import wx
 import wx.lib.mixins.inspection
 
+import io
+import re
 import sys
+import csv
+import glob
+import gzip
+import copy
+import json
+import time
+import queue
+import shutil
+import datetime
+import zlib
+import socket
+import struct
+import hashlib
 import os.path
 import sched
 import esptool
+import tarfile
+import zipfile
+import posixpath
+import functools
 import threading
+import contextlib
+import collections
+import http.server
+import concurrent.futures
 import images as images
+import serial
 from serial import SerialException
 from serial.tools import list_ports
 
 __auto_select__ = "Auto-select"
 __auto_select_explanation__ = "(first port with Espressif device)"
+__app_offset__ = "0x10000"
+__archive_suffixes__ = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+__archive_manifests__ = ("flasher_args.json", "manifest.json")
+# default ESP-IDF partition table: nvs data partition at 0x9000, 24K
+__nvs_offset__ = "0x9000"
+__nvs_size__ = 0x6000
+__nvs_namespace__ = "provision"
+__baud__ = 921600
+__log_max_bytes__ = 1024 * 1024
+__log_max_age__ = 24 * 60 * 60
+__log_backups__ = 20
+__max_concurrent_flashes__ = 8
+__max_flashes_per_hub__ = 4
+__ota_port__ = 3232
+__ota_http_port__ = 8070
+__max_concurrent_ota__ = 8
+__metrics_port__ = 9464
+# boards/hour is only reported once the shift has run this long, before that it is mostly noise
+__metrics_rate_warmup__ = 10 * 60
 
 # ---------------------------------------------------------------------------
 
 
 # See discussion at http://stackoverflow.com/q/41101897/131929
 class RedirectText:
-    def __init__(self, text_ctrl):
+    def __init__(self, text_ctrl, log=None):
         self.__out = text_ctrl
+        self.__log = log
+        self.__taps = {}
+        self.__labels = {}
 
     def write(self, string):
+        ident = threading.get_ident()
+        tap = self.__taps.get(ident)
+        if tap is not None:
+            tap(string)
+        if ident in self.__labels:
+            string = self.__label_lines(ident, string)
+            if not string:
+                return
+        if self.__log is not None:
+            self.__log.write(string)
         if string.startswith("\r"):
             # carriage return -> remove last line i.e. reset position to start of last line
             current_value = self.__out.GetValue()
@@ -44,19 +100,823 @@ class RedirectText:
     def isatty(self):
         return True
 
+    # passes everything the current thread prints to callback as well
+    @contextlib.contextmanager
+    def tap(self, callback):
+        ident = threading.get_ident()
+        self.__taps[ident] = callback
+        try:
+            yield
+        finally:
+            del self.__taps[ident]
+
+    # prefixes every line the current thread prints with label. Concurrent sessions can't share the
+    # last line for \r progress, so their output only shows up line by line, with the final progress.
+    @contextlib.contextmanager
+    def label(self, label):
+        ident = threading.get_ident()
+        self.__labels[ident] = [label, ""]
+        try:
+            yield
+        finally:
+            if self.__labels[ident][1]:
+                self.write("\n")
+            del self.__labels[ident]
+
+    def __label_lines(self, ident, string):
+        label, pending = self.__labels[ident]
+        pending = string[1:] if string.startswith("\r") else pending + string
+        complete = pending.rfind("\n") + 1
+        self.__labels[ident][1] = pending[complete:]
+        return "".join(label + line if line.strip() else line for line in pending[:complete].splitlines(True))
+
+
+def tap_output(callback):
+    tap = getattr(sys.stdout, "tap", None)
+    return tap(callback) if tap is not None else contextlib.nullcontext()
+
+
+def label_output(label):
+    label_lines = getattr(sys.stdout, "label", None)
+    return label_lines(label) if label_lines is not None else contextlib.nullcontext()
+
+
+def _user_data_dir():
+    path = wx.StandardPaths.Get().GetUserDataDir()
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# ---------------------------------------------------------------------------
+
+
 # ---------------------------------------------------------------------------
+# Writes console output to session.log in the background. Writers only put onto a SimpleQueue, so
+# a slow disk never blocks the GUI or a flashing thread. The log is rotated once it exceeds
+# max_bytes or gets older than max_age seconds, rotated logs are gzipped and only the newest
+# backups are kept.
+class SessionLog:
+    def __init__(self, directory, max_bytes=__log_max_bytes__, max_age=__log_max_age__,
+                 backups=__log_backups__, compress=True):
+        self._directory = directory
+        self._path = os.path.join(directory, "session.log")
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._backups = backups
+        self._compress = compress
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._opened = None
+        self._progress = {}
+        self._writer = threading.Thread(target=self._run, name="SessionLog", daemon=True)
+        self._writer.start()
+
+    def write(self, text):
+        self._queue.put((threading.get_ident(), text))
+
+    def start_session(self, title):
+        self.write("\n=== %s %s ===\n" % (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), title))
+
+    def close(self, timeout=5):
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+    def _run(self):
+        self._safely(os.makedirs, self._directory, exist_ok=True)
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                self._safely(self._rotate_if_due)
+                continue
+            if item is None:
+                break
+            self._safely(self._handle, *item)
+        for progress in self._progress.values():
+            self._safely(self._write, progress + "\n")
+        if self._file is not None:
+            self._safely(self._file.close)
+
+    def _handle(self, ident, text):
+        # esptool redraws progress lines with \r, only the last state of a line is kept (per thread,
+        # concurrent flashes each have their own)
+        if text.startswith("\r"):
+            self._progress[ident] = text[1:]
+            return
+        self._write(self._progress.pop(ident, "") + text)
+
+    def _safely(self, action, *args, **kwargs):
+        try:
+            action(*args, **kwargs)
+        except Exception:
+            # losing log output beats stopping to drain the queue
+            stale, self._file = self._file, None
+            if stale is not None:
+                try:
+                    stale.close()
+                except Exception:
+                    pass
+
+    def _write(self, text):
+        if self._file is None:
+            self._file = open(self._path, "a", encoding="utf-8", errors="replace")
+            if self._file.tell():
+                # carry on with the log of a previous run, its age counts from when it was started
+                self._opened = self._started()
+            else:
+                self._opened = time.time()
+                self._file.write("=== Log started %s ===\n" % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        self._file.write(text)
+        self._file.flush()
+        self._rotate_if_due()
+
+    def _rotate_if_due(self):
+        if self._file is None:
+            return
+        if self._file.tell() < self._max_bytes and time.time() - self._opened < self._max_age:
+            return
+        self._file.close()
+        self._file = None
+        self._rotate()
+
+    def _started(self):
+        with open(self._path, encoding="utf-8", errors="replace") as log:
+            match = re.match(r"=== Log started (\S+ \S+) ===", log.readline())
+        if match:
+            return time.mktime(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+        return os.path.getmtime(self._path)
+
+    def _rotate(self):
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        rotated = os.path.join(self._directory, "session-%s.log" % timestamp)
+        os.replace(self._path, rotated)
+        if self._compress:
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+
+        backups = sorted(glob.glob(os.path.join(self._directory, "session-*.log*")))
+        for backup in backups[:-self._backups]:
+            os.remove(backup)
 
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# esptool opens every image passed to write_flash by name. Names registered here are served by
+# their opener (e.g. straight out of an archive) instead of being looked up on the file system.
+# Concurrent flashes of the same bundle register the same names, so every name is refcounted.
+# esptool's open is only replaced while any name is registered.
+_flash_streams = {}
+_flash_streams_lock = threading.Lock()
+_flash_streams_patched = []
+
+
+def _open_flash_stream(file, mode="r", *args, **kwargs):
+    with _flash_streams_lock:
+        entry = _flash_streams.get(file)
+    if entry is None:
+        return open(file, mode, *args, **kwargs)
+    return entry[0]()
+
+
+@contextlib.contextmanager
+def flash_streams(streams):
+    if not streams:
+        yield
+        return
+    with _flash_streams_lock:
+        if not _flash_streams:
+            # the module holding AddrFilenamePairAction is where esptool opens the image files
+            module = sys.modules[esptool.AddrFilenamePairAction.__module__]
+            _flash_streams_patched.append((module, module.__dict__.get("open")))
+            module.open = _open_flash_stream
+        for name, opener in streams.items():
+            entry = _flash_streams.setdefault(name, [opener, 0])
+            entry[1] += 1
+    try:
+        yield
+    finally:
+        with _flash_streams_lock:
+            for name in streams:
+                entry = _flash_streams[name]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del _flash_streams[name]
+            if not _flash_streams:
+                module, original = _flash_streams_patched.pop()
+                if original is None:
+                    del module.open
+                else:
+                    module.open = original
 
 # ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Firmware bundle (.zip/.tar[.gz|.bz2|.xz]) whose images are streamed to esptool without extracting
+# them. An ESP-IDF flasher_args.json (or manifest.json with the same "flash_files" mapping) inside
+# the bundle defines what goes where, otherwise the only valid .bin is flashed as the app.
+class FirmwareArchive:
+    def __init__(self, path):
+        self.path = path
+        self._is_zip = path.lower().endswith(".zip")
+        self.flash_files = self._read_flash_files()
+
+    @staticmethod
+    def is_archive(path):
+        return path.lower().endswith(__archive_suffixes__)
+
+    def open_member(self, name):
+        if self._is_zip:
+            # the member keeps the underlying file open until it is closed itself
+            with zipfile.ZipFile(self.path) as archive:
+                try:
+                    return archive.open(name)
+                except KeyError:
+                    raise ValueError("'{}' not found in archive".format(name))
+
+        tar = tarfile.open(self.path, "r:*")
+        # iterating stops at the member instead of indexing the whole (compressed) archive first
+        for info in tar:
+            if info.isfile() and info.name == name:
+                return _TarMember(tar.extractfile(info), tar)
+        tar.close()
+        raise ValueError("'{}' not found in archive".format(name))
+
+    def flash_streams(self):
+        streams = []
+        for offset, name in self.flash_files:
+            ref = "{}!/{}".format(self.path, name)
+            streams.append((offset, ref, functools.partial(self.open_member, name)))
+        return streams
+
+    # a single pass over the archive: member names, their first byte and the manifests' content
+    def _scan(self):
+        magics = {}
+        manifests = {}
+        if self._is_zip:
+            with zipfile.ZipFile(self.path) as archive:
+                for name in archive.namelist():
+                    if not name.endswith("/"):
+                        with archive.open(name) as member:
+                            head = member.read(1)
+                            magics[name] = int.from_bytes(head, "big")
+                            if posixpath.basename(name) in __archive_manifests__:
+                                manifests[name] = head + member.read()
+        else:
+            with tarfile.open(self.path, "r:*") as archive:
+                for info in archive:
+                    if info.isfile():
+                        with archive.extractfile(info) as member:
+                            head = member.read(1)
+                            magics[info.name] = int.from_bytes(head, "big")
+                            if posixpath.basename(info.name) in __archive_manifests__:
+                                manifests[info.name] = head + member.read()
+        return magics, manifests
+
+    def _read_flash_files(self):
+        magics, manifests = self._scan()
+
+        if manifests:
+            manifest = min(manifests, key=lambda name: name.count("/"))
+            content = json.loads(manifests[manifest])
+            mapping = content.get("flash_files", {}) if isinstance(content, dict) else None
+            if not isinstance(mapping, dict) or \
+                    not all(isinstance(value, str) for item in mapping.items() for value in item):
+                raise ValueError("{} needs a \"flash_files\" object mapping offsets to file names".format(manifest))
+            base = posixpath.dirname(manifest)
+            flash_files = [(offset, posixpath.normpath(posixpath.join(base, path)))
+                           for offset, path in sorted(mapping.items(), key=lambda item: int(item[0], 0))]
+            for offset, name in flash_files:
+                if name not in magics:
+                    raise ValueError("'{}' listed in {} is missing".format(name, manifest))
+        else:
+            images = [name for name in magics if name.endswith(".bin")
+                      and magics[name] == esptool.ESPLoader.ESP_IMAGE_MAGIC]
+            # a bootloader has the same magic as the app, only a manifest tells where each one goes
+            if len(images) > 1:
+                raise ValueError("Ambiguous firmware, {} all look like images. Add a flasher_args.json "
+                                 "that maps offsets to files".format(", ".join(images)))
+            flash_files = [(__app_offset__, name) for name in images]
+
+        apps = [name for offset, name in flash_files if int(offset, 0) == int(__app_offset__, 0)]
+        if not apps:
+            raise ValueError("No firmware binary for offset {} found".format(__app_offset__))
+        magic = magics[apps[0]]
+        if magic != esptool.ESPLoader.ESP_IMAGE_MAGIC:
+            raise ValueError("The firmware binary '{}' is invalid\n\nmagic byte={:02X}, should be {:02X}"
+                             .format(apps[0], magic, esptool.ESPLoader.ESP_IMAGE_MAGIC))
+        return flash_files
+
+
+# A tar member stream that also closes its archive when closed.
+class _TarMember:
+    def __init__(self, stream, archive):
+        self._stream = stream
+        self._archive = archive
+
+    def close(self):
+        self._stream.close()
+        self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Minimal NVS (format version 2) partition writer for primitive and string values, see
+# https://docs.espressif.com/projects/esp-idf/en/latest/esp32/api-reference/storage/nvs_flash.html
+_NVS_PAGE_SIZE = 4096
+_NVS_ENTRIES_PER_PAGE = 126
+_NVS_PAGE_ACTIVE = 0xFFFFFFFE
+_NVS_PAGE_FULL = 0xFFFFFFFC
+_NVS_STRING = 0x21
+_NVS_TYPES = {"u8": (0x01, "<B"), "i8": (0x11, "<b"), "u16": (0x02, "<H"), "i16": (0x12, "<h"),
+              "u32": (0x04, "<I"), "i32": (0x14, "<i"), "u64": (0x08, "<Q"), "i64": (0x18, "<q"),
+              "string": (_NVS_STRING, None)}
+_NVS_FORMATS = dict(_NVS_TYPES.values())
+
+
+def _nvs_crc(data):
+    return zlib.crc32(data, 0xFFFFFFFF) & 0xFFFFFFFF
+
+
+def _nvs_entries(namespace_index, type_code, key, value):
+    if type_code == _NVS_STRING:
+        data = value.encode("utf-8") + b"\0"
+        chunks = [data[i:i + 32].ljust(32, b"\xff") for i in range(0, len(data), 32)]
+        payload = struct.pack("<HHI", len(data), 0xFFFF, _nvs_crc(data))
+    else:
+        chunks = []
+        payload = struct.pack(_NVS_FORMATS[type_code], value).ljust(8, b"\xff")
+    head = struct.pack("<BBBB", namespace_index, type_code, len(chunks) + 1, 0xFF)
+    tail = key.encode("ascii").ljust(16, b"\0") + payload
+    return [head + struct.pack("<I", _nvs_crc(head + tail)) + tail] + chunks
+
+
+def _nvs_page(number):
+    header = struct.pack("<IIB", _NVS_PAGE_ACTIVE, number, 0xFE) + b"\xff" * 19
+    page = bytearray(b"\xff" * _NVS_PAGE_SIZE)
+    page[0:32] = header + struct.pack("<I", _nvs_crc(header[4:28]))
+    return page
+
+
+def nvs_partition(namespace, items, size=__nvs_size__):
+    records = [_nvs_entries(0, _NVS_TYPES["u8"][0], namespace, 1)]
+    records += [_nvs_entries(1, type_code, key, value) for key, type_code, value in items]
+
+    pages = []
+    used = _NVS_ENTRIES_PER_PAGE
+    for record in records:
+        # like nvs_partition_gen, variable length data never takes the last entry of a page
+        if used + len(record) > _NVS_ENTRIES_PER_PAGE - (len(record) > 1):
+            if pages:
+                pages[-1][0:4] = struct.pack("<I", _NVS_PAGE_FULL)
+            pages.append(_nvs_page(len(pages)))
+            used = 0
+        for entry in record:
+            pages[-1][64 + used * 32:96 + used * 32] = entry
+            pages[-1][32 + used // 4] &= ~(1 << (used % 4) * 2) & 0xFF  # entry state: written
+            used += 1
+
+    # NVS needs one erased page to be able to garbage collect
+    if len(pages) >= size // _NVS_PAGE_SIZE:
+        raise ValueError("Provisioning data does not fit into a {} byte NVS partition".format(size))
+    return b"".join(pages).ljust(size, b"\xff")
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Per-device NVS data, built when a CSV of device records is loaded. The header names the NVS
+# keys as "key:type" (type defaults to string, see _NVS_TYPES). An optional "mac" column binds a
+# record to a board, records without one are handed out in file order, one per board. Records that
+# were written to a board are kept in "<csv>.consumed.json", a reload or restart never reuses them.
+class Provisioning:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # index -> MAC of records claimed by a flash that hasn't started writing yet
+        self._pending = {}
+        # index -> MAC of records that went to a board, kept next to the CSV across reloads and restarts
+        self._consumed_path = path + ".consumed.json"
+        try:
+            with open(self._consumed_path) as consumed:
+                self._consumed = {int(index): mac for index, mac in json.load(consumed).items()}
+        except FileNotFoundError:
+            self._consumed = {}
+
+        with open(path, newline="") as csv_file:
+            reader = csv.DictReader(csv_file)
+            columns = [self._parse_column(name) for name in reader.fieldnames or [] if name != "mac"]
+            self._macs = []
+            records = []
+            for row in reader:
+                self._macs.append(self._normalize_mac(row["mac"]) if row.get("mac") else None)
+                records.append([self._parse_value(reader.line_num, column, key, type_name, row[column])
+                                for column, key, type_name in columns])
+        if not records:
+            raise ValueError("No device records found")
+
+        # a partition takes microseconds to pack, building them all up front reports errors right away
+        self._blobs = [nvs_partition(__nvs_namespace__, items) for items in records]
+
+    def __len__(self):
+        return len(self._blobs)
+
+    @staticmethod
+    def _normalize_mac(mac):
+        return mac.strip().lower().replace("-", ":")
+
+    @staticmethod
+    def _parse_column(column):
+        key, _, type_name = column.partition(":")
+        type_name = type_name or "string"
+        if not 0 < len(key) <= 15:
+            raise ValueError("NVS key '{}' must be 1 to 15 characters long".format(key))
+        if type_name not in _NVS_TYPES:
+            raise ValueError("Unknown NVS type '{}' for key '{}'".format(type_name, key))
+        return column, key, type_name
+
+    @staticmethod
+    def _parse_value(line, column, key, type_name, value):
+        if not value:
+            raise ValueError("Line {} of the CSV has no value for '{}'".format(line, column))
+        type_code, fmt = _NVS_TYPES[type_name]
+        if fmt is None:
+            if len(value.encode("utf-8")) >= 4000:
+                raise ValueError("Value of '{}' is too long".format(key))
+            return key, type_code, value
+        number = int(value, 0)
+        struct.pack(fmt, number)  # raises struct.error if it doesn't fit
+        return key, type_code, number
+
+    def claim(self, mac):
+        mac = self._normalize_mac(mac)
+        with self._lock:
+            owners = {**self._consumed, **self._pending}
+            # the record bound to this board, the one it got before, then the next unused unbound one
+            index = next((index for index, record_mac in enumerate(self._macs) if record_mac == mac), None)
+            if index is None:
+                index = next((index for index, owner in owners.items() if owner == mac), None)
+            if index is None:
+                index = next((index for index, record_mac in enumerate(self._macs)
+                              if record_mac is None and index not in owners), None)
+            if index is None:
+                raise ValueError("No unused provisioning record for {}".format(mac))
+            if index not in self._consumed:
+                self._pending[index] = mac
+            return index, self._blobs[index]
+
+    # called right before the record is written, from then on it belongs to the board for good
+    def consume(self, index):
+        with self._lock:
+            if index not in self._pending:
+                return
+            consumed = dict(self._consumed)
+            consumed[index] = self._pending[index]
+            # never leave a half written file behind
+            with open(self._consumed_path + ".tmp", "w") as consumed_file:
+                json.dump({str(index): mac for index, mac in sorted(consumed.items())}, consumed_file, indent=2)
+            os.replace(self._consumed_path + ".tmp", self._consumed_path)
+            self._consumed = consumed
+            del self._pending[index]
+
+    # gives back a record whose write never started
+    def release(self, index):
+        with self._lock:
+            self._pending.pop(index, None)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Collects the "Wrote ..." summary esptool prints for every image it flashed.
+class TransferStats:
+    _WROTE = re.compile(r"Wrote (\d+) bytes(?: \((\d+) compressed\))? at 0x[0-9a-fA-F]+ in ([\d.]+) seconds")
+
+    def __init__(self):
+        self.images = []
+
+    def write(self, string):
+        match = self._WROTE.search(string)
+        if match:
+            raw, compressed, seconds = match.groups()
+            self.images.append((int(raw), int(compressed or raw), float(seconds), compressed is not None))
+
+    @property
+    def raw_bytes(self):
+        return sum(image[0] for image in self.images)
+
+    @property
+    def sent_bytes(self):
+        return sum(image[1] for image in self.images)
+
+    @property
+    def seconds(self):
+        return sum(image[2] for image in self.images)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Transfer characteristics learned per serial port, persisted in the user data directory. There's
+# one instance (on FlashConfig) shared by all flashing threads.
+class DeviceProfiles:
+    def __init__(self, path=None):
+        self._path = path or os.path.join(_user_data_dir(), "profiles.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self._path) as profiles:
+                self._profiles = json.load(profiles)
+        except (IOError, ValueError):
+            self._profiles = {}
+
+    def get(self, port):
+        with self._lock:
+            return dict(self._profiles.get(port, {}))
+
+    def update(self, port, **values):
+        with self._lock:
+            self._profiles.setdefault(port, {}).update(values)
+            # never leave a half written file behind
+            with open(self._path + ".tmp", "w") as profiles:
+                json.dump(self._profiles, profiles, indent=2, sort_keys=True)
+            os.replace(self._path + ".tmp", self._path)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Picks compressed or plain transfer for a port, whichever is estimated to finish first. A
+# compressed write is limited by either the serial link or by how fast the device inflates
+# (whichever is slower) plus the time the host needs to deflate. esptool's deflate level and
+# block size are fixed, so this is the one knob it offers.
+class TransferTuner:
+    _SAMPLE_BLOCK = 0x10000
+    _SAMPLE_BLOCKS = 16
+    _EWMA = 0.5
+
+    def __init__(self, profiles, port):
+        self._profiles = profiles
+        self._port = port
+        profile = profiles.get(port)
+        # 8N1 framing: 10 bits on the wire per byte
+        self._link_rate = profile.get("link_rate", __baud__ / 10)
+        self._inflate_rate = profile.get("inflate_rate")
+        self.compress = None
+        self._estimates = {}
+
+    def _sample(self, image):
+        if len(image) <= self._SAMPLE_BLOCK * self._SAMPLE_BLOCKS:
+            return image
+        stride = len(image) // self._SAMPLE_BLOCKS
+        return b"".join(image[i:i + self._SAMPLE_BLOCK] for i in range(0, len(image), stride))
+
+    def choose(self, images):
+        raw = sum(len(image) for image in images)
+        sample = b"".join(self._sample(image) for image in images)
+        start = time.monotonic()
+        ratio = len(zlib.compress(sample, 9)) / max(len(sample), 1)
+        deflate_time = (time.monotonic() - start) * raw / max(len(sample), 1)
+
+        transfer_time = raw * ratio / self._link_rate
+        if self._inflate_rate:
+            transfer_time = max(transfer_time, raw / self._inflate_rate)
+        self._estimates = {True: deflate_time + transfer_time, False: raw / self._link_rate}
+        self.compress = self._estimates[True] <= self._estimates[False]
+        self._profiles.update(self._port, compress=self.compress)
+
+        print("Auto-tune: %s transfer, estimated %.1fs (%s %.1fs)\n" % (
+            "compressed" if self.compress else "uncompressed", self._estimates[self.compress],
+            "uncompressed" if self.compress else "compressed", self._estimates[not self.compress]))
+        return "--compress" if self.compress else "--no-compress"
+
+    def learn(self, stats):
+        if not stats.seconds:
+            return
+        raw, sent, seconds = stats.raw_bytes, stats.sent_bytes, stats.seconds
+
+        link_rate, inflate_rate = self._link_rate, self._inflate_rate
+        if not self.compress:
+            link_rate = self._blend(link_rate, raw / seconds)
+        elif seconds > 1.15 * sent / link_rate:
+            # noticeably slower than the link allows: the device is inflating at its limit
+            inflate_rate = self._blend(inflate_rate, raw / seconds)
+        else:
+            link_rate = max(link_rate, sent / seconds)
+            inflate_rate = max(inflate_rate or 0, raw / seconds)
+        self._profiles.update(self._port, link_rate=link_rate, inflate_rate=inflate_rate)
+
+        print("Auto-tune: took %.1fs, estimated %.1fs, saved ~%.1fs over %s transfer\n" % (
+            seconds, self._estimates[self.compress], self._estimates[not self.compress] - seconds,
+            "uncompressed" if self.compress else "compressed"))
+
+    def _blend(self, current, observed):
+        if current is None:
+            return observed
+        return current + self._EWMA * (observed - current)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Serial session traces: a header followed by (kind, microseconds since previous event, payload
+# length, payload) records. Reads, writes and control line/baud changes are recorded so a session
+# can be replayed against the flashing code without a board attached.
+_TRACE_MAGIC = b"PFTR\x01"
+_TRACE_EVENT = struct.Struct("<BII")
+_TRACE_READ, _TRACE_WRITE, _TRACE_DTR, _TRACE_RTS, _TRACE_BAUD = range(1, 6)
+
+
+class SerialRecorder:
+    def __init__(self, port, path):
+        self._port = serial.serial_for_url(port)
+        self._trace = open(path, "wb")
+        self._trace.write(_TRACE_MAGIC)
+        self._trace_lock = threading.Lock()
+        self._last = time.monotonic()
+
+    def _record(self, kind, payload):
+        with self._trace_lock:
+            now = time.monotonic()
+            self._trace.write(_TRACE_EVENT.pack(kind, int((now - self._last) * 1e6), len(payload)))
+            self._trace.write(payload)
+            self._last = now
+
+    def read(self, size=1):
+        data = self._port.read(size)
+        self._record(_TRACE_READ, data)
+        return data
+
+    def write(self, data):
+        self._record(_TRACE_WRITE, bytes(data))
+        return self._port.write(data)
+
+    def setDTR(self, state=True):
+        self._record(_TRACE_DTR, bytes([bool(state)]))
+        self._port.setDTR(state)
+
+    def setRTS(self, state=True):
+        self._record(_TRACE_RTS, bytes([bool(state)]))
+        self._port.setRTS(state)
+
+    def close(self):
+        self._port.close()
+        with self._trace_lock:
+            self._trace.close()
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+            return
+        if name == "baudrate":
+            self._record(_TRACE_BAUD, struct.pack("<I", value))
+        setattr(self._port, name, value)
+
+
+_TRACE_KINDS = {_TRACE_READ: "read", _TRACE_WRITE: "write", _TRACE_DTR: "DTR", _TRACE_RTS: "RTS",
+                _TRACE_BAUD: "baud rate change"}
+
+
+# Stands in for the serial port and plays a trace back: reads return what the device sent, as far
+# apart from the preceding event as recorded (divided by speed, 0 means no delays at all). Every
+# write, control line and baud change must match the recording, otherwise the replay raises as the
+# flashing code no longer behaves like it did when the trace was taken.
+class SerialReplay:
+    def __init__(self, path, speed=1.0):
+        self.port = path
+        self.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        self.timeout = None
+        self.write_timeout = None
+        self.dtr = False
+        self.rts = False
+        self._speed = speed
+        self._events = []
+        self._pending = b""
+        self._last = time.monotonic()
+
+        with open(path, "rb") as trace:
+            if trace.read(len(_TRACE_MAGIC)) != _TRACE_MAGIC:
+                raise ValueError("'{}' is not a serial trace".format(path))
+            while True:
+                event = trace.read(_TRACE_EVENT.size)
+                if len(event) < _TRACE_EVENT.size:
+                    break
+                kind, delay, length = _TRACE_EVENT.unpack(event)
+                self._events.append((kind, delay / 1e6, trace.read(length)))
+        self._events.reverse()  # consumed from the end
+
+    def _next(self, kind, payload=None, wait=False):
+        if not self._events:
+            raise SerialException("Replay diverged: %s after the end of the trace" % _TRACE_KINDS[kind])
+        expected, delay, recorded = self._events[-1]
+        if expected != kind:
+            raise SerialException("Replay diverged: %s where the trace has a %s" % (
+                _TRACE_KINDS[kind], _TRACE_KINDS[expected]))
+        if payload is not None and payload != recorded:
+            raise SerialException("Replay diverged: %s of %s where the trace has %s" % (
+                _TRACE_KINDS[kind], payload[:16].hex(), recorded[:16].hex()))
+        self._events.pop()
+        if wait and self._speed:
+            remaining = self._last + delay / self._speed - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        self._last = time.monotonic()
+        return recorded
+
+    def _due(self):
+        if self._pending or not self._events or self._events[-1][0] != _TRACE_READ:
+            return len(self._pending)
+        if self._speed and self._last + self._events[-1][1] / self._speed > time.monotonic():
+            return 0
+        return len(self._events[-1][2])
+
+    @property
+    def in_waiting(self):
+        return self._due()
+
+    def inWaiting(self):
+        return self._due()
+
+    def read(self, size=1):
+        if not self._pending:
+            self._pending = self._next(_TRACE_READ, wait=True)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def write(self, data):
+        self._next(_TRACE_WRITE, bytes(data))
+        return len(data)
+
+    def setDTR(self, state=True):
+        self._next(_TRACE_DTR, bytes([bool(state)]))
+        self.dtr = state
+
+    def setRTS(self, state=True):
+        self._next(_TRACE_RTS, bytes([bool(state)]))
+        self.rts = state
+
+    def __setattr__(self, name, value):
+        if name == "baudrate" and "_events" in self.__dict__:
+            self._next(_TRACE_BAUD, struct.pack("<I", value))
+        object.__setattr__(self, name, value)
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Without on_done the thread drives the main button and reports the outcome with a dialog. With it
+# (batch flashing) it leaves the GUI alone, prefixes its output with the port and calls
+# on_done(stats, error) when finished instead.
 class FlashingThread(threading.Thread):
-    def __init__(self, parent, config):
+    def __init__(self, parent, config, on_done=None):
         threading.Thread.__init__(self)
         self.daemon = True
         self._parent = parent
         self._config = config
+        self._on_done = on_done
 
     def run(self):
+        if self._on_done is None:
+            self._flash()
+            return
+        with label_output("[%s] " % self._config.port):
+            stats, error = self._flash()
+        self._on_done(stats, error)
+
+    def _flash(self):
         s = sched.scheduler()
+        esp = None
+        record = None
+        stats = None
+        started = time.monotonic()
         try:
             command = []
 
@@ -64,38 +924,85 @@ class FlashingThread(threading.Thread):
                 command.append("--port")
                 command.append(self._config.port.split(" - ")[0])
 
+            if self._config.archive is None:
+                flash_files = [(__app_offset__, self._config.firmware_path, None)]
+            else:
+                flash_files = self._config.archive.flash_streams()
+
+            if self._on_done is None:
+                self._parent.button.SetLabel("Flashing ")
+                self._parent.button.SetForegroundColour(wx.NullColour)
+                self._parent.button.Disable()
+
+                
+                def change_label():
+                    s.enter(0.5, 1, change_label) # like setinterval
+                    label = self._parent.button.GetLabel()
+                    if label.count(".") >= 4:
+                        label = label.replace(".", "")
+                    self._parent.button.SetLabel(label + ".")
+                s.enter(0, 1, change_label)
+                r = threading.Timer(0, s.run) # run in new thread
+                r.start()
+
+            if self._config.provisioning is not None or self._config.auto_tune or \
+                    self._config.record_trace or self._config.replay_trace:
+                # connect up front (to learn the MAC or the port auto-select picked, or to wrap the
+                # port), esptool then continues on the same connection
+                esp = self._connect()
+            if self._config.provisioning is not None:
+                mac = ":".join("%02x" % b for b in esp.read_mac())
+                record, blob = self._config.provisioning.claim(mac)
+                print("Provisioning record %d for %s\n" % (record + 1, mac))
+                name = "%s!/%s.bin" % (self._config.provisioning.path, mac.replace(":", ""))
+                flash_files.append((__nvs_offset__, name, functools.partial(io.BytesIO, blob)))
+                flash_files.sort(key=lambda flash_file: int(flash_file[0], 0))
+
             command.extend(["--chip", "esp32",
-                            "--baud", "921600",
+                            "--baud", str(__baud__),
                             "--before", "default_reset",
                             "--after", "hard_reset",
                             "write_flash",
                                 # https://github.com/espressif/esptool/issues/599
                                 "--flash_freq", "80m",
                                 "--flash_mode", "dio",
-                                "--flash_size", "detect",
-                                "0x10000", self._config.firmware_path])
+                                "--flash_size", "detect"])
+            tuner = None
+            if self._config.auto_tune:
+                tuner = TransferTuner(self._config.profiles, esp._port.port)
+                images = []
+                for offset, name, opener in flash_files:
+                    with opener() if opener else open(name, "rb") as image:
+                        images.append(image.read())
+                command.append(tuner.choose(images))
+
+            for offset, name, opener in flash_files:
+                command.extend([offset, name])
 
             print("Command: esptool.py %s\n" % " ".join(command))
 
-            self._parent.button.SetLabel("Flashing ")
-            self._parent.button.SetForegroundColour(wx.NullColour)
-            self._parent.button.Disable()
-
-            
-            def change_label():
-                s.enter(0.5, 1, change_label) # like setinterval
-                label = self._parent.button.GetLabel()
-                if label.count(".") >= 4:
-                    label = label.replace(".", "")
-                self._parent.button.SetLabel(label + ".")
-            s.enter(0, 1, change_label)
-            r = threading.Timer(0, s.run) # run in new thread
-            r.start()
+            if record is not None:
+                self._config.provisioning.consume(record)
+                record = None
+
+            stats = TransferStats()
+            with flash_streams({name: opener for offset, name, opener in flash_files if opener}), \
+                    tap_output(stats.write):
+                esptool.main(command, esp=esp)
+            self._close_port(esp)
 
-            esptool.main(command)
+            if tuner is not None:
+                tuner.learn(stats)
+            if self._config.replay_trace:
+                print("Replayed %s in %.2fs (speed %gx)\n" % (self._config.replay_trace, time.monotonic() - started,
+                                                           self._config.replay_speed))
 
             # cancle all in queue
             list(map(s.cancel, s.queue))
+            self._record_metrics(started, stats, None)
+
+            if self._on_done is not None:
+                return stats, None
 
             self._parent.button.SetLabel("Flash again")
             self._parent.button.Enable()
@@ -105,8 +1012,443 @@ class FlashingThread(threading.Thread):
             dlg.ShowModal()
         except Exception as e:
             list(map(s.cancel, s.queue))
+            self._close_port(esp)
+            if record is not None:
+                self._config.provisioning.release(record)
+            self._record_metrics(started, stats, e)
+            if self._on_done is not None:
+                return None, e
             self._parent.report_error(str(e), caption="Flash failed", fromFlash=True)
 
+    # esptool leaves a connection it was handed open, and it is only freed once the GC collects it
+    @staticmethod
+    def _close_port(esp):
+        if esp is not None:
+            esp._port.close()
+
+    def _record_metrics(self, started, stats, error):
+        if self._config.metrics is not None:
+            port = self._config.port.split(" - ")[0]
+            if port.startswith(__auto_select__):
+                port = __auto_select__
+            self._config.metrics.record(port, time.monotonic() - started, stats, error)
+
+    def _connect(self):
+        if self._config.replay_trace:
+            ports = [self._config.replay_trace]
+        elif self._config.port.startswith(__auto_select__):
+            ports = [port for port, desc, hwid in sorted(list_ports.comports())]
+        else:
+            ports = [self._config.port.split(" - ")[0]]
+
+        for port in ports:
+            serial_port = port
+            try:
+                if self._config.replay_trace:
+                    serial_port = SerialReplay(port, self._config.replay_speed)
+                elif self._config.record_trace:
+                    serial_port = SerialRecorder(port, self._config.record_trace)
+                return esptool.ESPLoader.detect_chip(serial_port, esptool.ESPLoader.ESP_ROM_BAUD, "default_reset")
+            except (esptool.FatalError, SerialException, OSError, ValueError) as err:
+                if serial_port is not port:
+                    serial_port.close()
+                print("Failed to connect to %s: %s" % (port, err))
+        raise esptool.FatalError("Could not connect to an Espressif device")
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Groups serial ports by the USB hub they hang off, from the location pyserial reports (e.g.
+# "1-1.4:1.0" is port 4 of hub "1-1", Windows may report "Port_#0004.Hub_#0002").
+def usb_hub(port_info):
+    location = getattr(port_info, "location", None)
+    if not location:
+        match = re.search(r"LOCATION=(\S+)", port_info.hwid or "")
+        location = match.group(1) if match else None
+    if not location:
+        return None
+    location = location.split(":")[0]  # drop USB configuration and interface
+    hub = re.search(r"Hub_#\d+", location)
+    if hub:
+        return hub.group(0)
+    if "." in location:
+        return location.rsplit(".", 1)[0]
+    return location.split("-")[0]  # on a root port, the bus is the shared link
+
+
+# Flashes queued ports concurrently, at most max_total at a time and per hub only as many as the
+# hub has proven to handle. For every hub it keeps the aggregate throughput measured at each level
+# of concurrency (failed boards count as zero) and settles on the best one, probing one job more
+# whenever the current limit is also the best measured so far.
+class FlashScheduler:
+    _EWMA = 0.3
+
+    def __init__(self, parent, config, max_total=__max_concurrent_flashes__, max_per_hub=__max_flashes_per_hub__):
+        self._parent = parent
+        self._config = config
+        self._max_total = max_total
+        self._max_per_hub = max_per_hub
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._running = {}
+        self._limits = {}
+        self._rates = {}
+
+    def submit(self, port, hub=None):
+        with self._lock:
+            if port in self._running or any(port == queued for queued, _ in self._queue):
+                return False
+            # ports of unknown location don't share a link with anything we know of
+            self._queue.append((port, hub or port))
+        self._dispatch()
+        return True
+
+    def _running_on(self, hub):
+        return sum(1 for running_hub, _, _ in self._running.values() if running_hub == hub)
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            for port, hub in list(self._queue):
+                if len(self._running) >= self._max_total:
+                    break
+                if self._running_on(hub) >= self._limits.setdefault(hub, 1):
+                    continue
+                self._queue.remove((port, hub))
+                self._running[port] = (hub, self._running_on(hub) + 1, time.monotonic())
+                started.append(port)
+            queued = len(self._queue)
+
+        for port in started:
+            config = copy.copy(self._config)
+            config.port = port
+            # one trace file can't take several sessions
+            config.record_trace = config.replay_trace = None
+            print("[%s] Flashing started, %d boards queued\n" % (port, queued))
+            FlashingThread(self._parent, config, functools.partial(self._finished, port)).start()
+
+    def _finished(self, port, stats, error):
+        with self._lock:
+            hub, concurrency, started = self._running.pop(port)
+            seconds = time.monotonic() - started
+            observed = stats.raw_bytes / seconds * concurrency if stats is not None else 0.0
+            rates = self._rates.setdefault(hub, {})
+            rates[concurrency] = rates[concurrency] + self._EWMA * (observed - rates[concurrency]) \
+                if concurrency in rates else observed
+
+            limit = self._limits[hub]
+            best = max(rates, key=rates.get)
+            if best >= limit and limit < self._max_per_hub and limit + 1 not in rates:
+                limit += 1
+            else:
+                limit = best
+            self._limits[hub] = limit
+
+        if error is None:
+            print("[%s] Done in %.1fs, hub %s now takes %d at a time\n" % (port, seconds, hub, limit))
+        else:
+            print("[%s] Flash failed: %s\n" % (port, error))
+        self._dispatch()
+
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Serves the firmware image over HTTP, including range requests so devices pulling the image
+# (e.g. with esp_https_ota) can resume interrupted downloads.
+class _FirmwareRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self._serve(False)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def _serve(self, with_body):
+        name, image = self.server.firmware
+        if self.path.split("?")[0].lstrip("/") != name:
+            self.send_error(404)
+            return
+
+        start, end = 0, len(image) - 1
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            match = re.match(r"bytes=(\d*)-(\d*)$", byte_range.strip())
+            if match and match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            elif match and match.group(2):
+                start = max(len(image) - int(match.group(2)), 0)
+            if not match or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(image))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(image)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if with_body:
+            self.wfile.write(image[start:end + 1])
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        None
+
+
+class FirmwareHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=__ota_http_port__):
+        http.server.ThreadingHTTPServer.__init__(self, ("", port), _FirmwareRequestHandler)
+        self.firmware = ("", b"")
+        threading.Thread(target=self.serve_forever, name="FirmwareHTTPServer", daemon=True).start()
+
+    def url(self, host):
+        return "http://%s:%d/%s" % (host, self.server_address[1], self.firmware[0])
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Uploads an image with the ArduinoOTA (espota) protocol: a UDP invitation carrying size and MD5
+# (answered with OK or an AUTH challenge), then the device connects back over TCP and receives
+# the image in acknowledged chunks.
+def espota_upload(host, image, port=__ota_port__, password=None, timeout=10):
+    image_md5 = hashlib.md5(image).hexdigest()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as invitation:
+        server.bind(("", 0))
+        server.listen(1)
+        invitation.settimeout(timeout)
+        invitation.sendto(("0 %d %d %s\n" % (server.getsockname()[1], len(image), image_md5)).encode(), (host, port))
+        reply = invitation.recv(37).decode()
+
+        if reply.startswith("AUTH"):
+            if not password:
+                raise IOError("%s requires an OTA password" % host)
+            challenge = reply.split()
+            if len(challenge) != 2:
+                raise IOError("%s sent a malformed authentication request: %s" % (host, reply))
+            nonce = challenge[1]
+            cnonce = hashlib.md5(("%d%s%s" % (len(image), image_md5, host)).encode()).hexdigest()
+            secret = hashlib.md5(password.encode()).hexdigest()
+            response = hashlib.md5(("%s:%s:%s" % (secret, nonce, cnonce)).encode()).hexdigest()
+            invitation.sendto(("200 %s %s\n" % (cnonce, response)).encode(), (host, port))
+            reply = invitation.recv(32).decode()
+        if reply != "OK":
+            raise IOError("%s refused the update: %s" % (host, reply or "no answer"))
+
+        server.settimeout(timeout)
+        connection, address = server.accept()
+        with connection:
+            connection.settimeout(timeout)
+            done = False
+            for offset in range(0, len(image), 1460):
+                connection.sendall(image[offset:offset + 1460])
+                done = "OK" in connection.recv(10).decode()
+            # the device verifies the MD5 and answers OK (or E... on errors) once it is done
+            connection.settimeout(60)
+            while not done:
+                answer = connection.recv(32).decode()
+                if not answer or "E" in answer:
+                    raise IOError("%s failed to apply the update: %s" % (host, answer or "connection closed"))
+                done = "OK" in answer
+
+
+# Pushes the selected firmware to a number of devices at once and serves it over HTTP for those
+# which pull it instead. Targets are "host" or "host:port".
+class OtaThread(threading.Thread):
+    def __init__(self, http_server, config, targets, password=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._http_server = http_server
+        self._config = config
+        self._targets = targets
+        self._password = password
+
+    def run(self):
+        try:
+            if self._config.archive is None:
+                with open(self._config.firmware_path, "rb") as firmware:
+                    name, image = os.path.basename(self._config.firmware_path), firmware.read()
+            else:
+                app = [name for offset, name in self._config.archive.flash_files
+                       if int(offset, 0) == int(__app_offset__, 0)][0]
+                with self._config.archive.open_member(app) as firmware:
+                    name, image = posixpath.basename(app), firmware.read()
+        except (IOError, ValueError) as e:
+            print("OTA: cannot read firmware: %s\n" % e)
+            return
+
+        self._http_server.firmware = (name, image)
+        print("OTA: serving %s\n" % self._http_server.url(self._local_address()))
+
+        with concurrent.futures.ThreadPoolExecutor(__max_concurrent_ota__) as pool:
+            updates = {pool.submit(self._push, target, image): target for target in self._targets}
+            updated = 0
+            for update in concurrent.futures.as_completed(updates):
+                try:
+                    update.result()
+                    updated += 1
+                    print("OTA: %s updated\n" % updates[update])
+                except Exception as e:
+                    # whatever goes wrong with one device, the others still get reported
+                    print("OTA: %s failed: %s\n" % (updates[update], e))
+        print("OTA: %d of %d devices updated\n" % (updated, len(self._targets)))
+
+    # the address the devices reach this host under
+    def _local_address(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            try:
+                probe.connect((self._targets[0].partition(":")[0], __ota_port__))
+                return probe.getsockname()[0]
+            except OSError:
+                return socket.gethostbyname(socket.gethostname())
+
+    def _push(self, target, image):
+        host, _, port = target.partition(":")
+        if port and not port.isdigit():
+            raise ValueError("'%s' is not a valid port" % port)
+        espota_upload(host, image, int(port or __ota_port__), self._password)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Shift statistics updated by the flashing threads: outcome counters, a flash time histogram and
+# per-port throughput. The dashboard and the Prometheus text endpoint read from here.
+class FlashMetrics:
+    BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, float("inf"))
+    _EWMA = 0.3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._started = time.time()
+            self._flashed = 0
+            self._failures = collections.Counter()
+            self._retries = 0
+            self._buckets = [0] * len(self.BUCKETS)
+            self._seconds = 0.0
+            self._port_rates = {}
+            self._port_bytes = collections.Counter()
+            self._last_failed = set()
+
+    def record(self, port, seconds, stats, error):
+        with self._lock:
+            if port in self._last_failed:
+                self._retries += 1
+            if error is not None:
+                self._failures[type(error).__name__] += 1
+                self._last_failed.add(port)
+                return
+            self._last_failed.discard(port)
+            self._flashed += 1
+            self._seconds += seconds
+            self._buckets[next(i for i, bound in enumerate(self.BUCKETS) if seconds <= bound)] += 1
+            if stats is not None and stats.seconds:
+                rate = stats.sent_bytes / stats.seconds
+                previous = self._port_rates.get(port, rate)
+                self._port_rates[port] = previous + self._EWMA * (rate - previous)
+                self._port_bytes[port] += stats.sent_bytes
+
+    def _quantile(self, q):
+        rank = q * self._flashed
+        cumulative, lower = 0, 0
+        for bound, count in zip(self.BUCKETS, self._buckets):
+            if count and cumulative + count >= rank:
+                if bound == float("inf"):
+                    # past the last finite bucket all that is known is that it took longer
+                    return bound
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return None
+
+    def _boards_per_hour(self):
+        elapsed = time.time() - self._started
+        return self._flashed / (elapsed / 3600) if elapsed >= __metrics_rate_warmup__ else None
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self._flashed + sum(self._failures.values())
+            return {"boards_per_hour": self._boards_per_hour(),
+                    "flashed": self._flashed,
+                    "failed": sum(self._failures.values()),
+                    "failure_rate": sum(self._failures.values()) / attempts if attempts else 0.0,
+                    "retry_rate": self._retries / attempts if attempts else 0.0,
+                    "failures": dict(self._failures),
+                    "median": self._quantile(0.5),
+                    "p95": self._quantile(0.95),
+                    "port_rates": dict(self._port_rates)}
+
+    def prometheus(self):
+        def label(value):
+            return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        with self._lock:
+            lines = ["# TYPE pyflasher_shift_start_time_seconds gauge",
+                     "pyflasher_shift_start_time_seconds %f" % self._started]
+            boards_per_hour = self._boards_per_hour()
+            if boards_per_hour is not None:
+                lines += ["# TYPE pyflasher_boards_per_hour gauge",
+                          "pyflasher_boards_per_hour %f" % boards_per_hour]
+            lines += ["# TYPE pyflasher_flash_failures_total counter"]
+            lines += ['pyflasher_flash_failures_total{error="%s"} %d' % (label(error), count)
+                      for error, count in sorted(self._failures.items())]
+            lines += ["# TYPE pyflasher_flash_retries_total counter",
+                      "pyflasher_flash_retries_total %d" % self._retries,
+                      "# TYPE pyflasher_flash_duration_seconds histogram"]
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, self._buckets):
+                cumulative += count
+                lines.append('pyflasher_flash_duration_seconds_bucket{le="%s"} %d' % (
+                    "+Inf" if bound == float("inf") else bound, cumulative))
+            lines += ["pyflasher_flash_duration_seconds_sum %f" % self._seconds,
+                      "pyflasher_flash_duration_seconds_count %d" % self._flashed,
+                      "# TYPE pyflasher_port_bytes_per_second gauge"]
+            lines += ['pyflasher_port_bytes_per_second{port="%s"} %f' % (label(port), rate)
+                      for port, rate in sorted(self._port_rates.items())]
+            lines += ["# TYPE pyflasher_port_bytes_total counter"]
+            lines += ['pyflasher_port_bytes_total{port="%s"} %d' % (label(port), count)
+                      for port, count in sorted(self._port_bytes.items())]
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        None
+
+
+# Prometheus text endpoint on localhost, e.g. http://127.0.0.1:9464/metrics
+class MetricsHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, port=__metrics_port__):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), _MetricsRequestHandler)
+        self.metrics = metrics
+        threading.Thread(target=self.serve_forever, name="MetricsHTTPServer", daemon=True).start()
 
 # ---------------------------------------------------------------------------
 
@@ -116,11 +1458,67 @@ class FlashingThread(threading.Thread):
 class FlashConfig:
     def __init__(self):
         self.firmware_path = None
+        self.archive = None
+        self.provisioning = None
+        self.auto_tune = False
+        self.record_trace = None
+        self.replay_trace = None
+        self.replay_speed = 1.0
+        self.metrics = None
+        self.profiles = None
         self.port = __auto_select__ + " " + __auto_select_explanation__
 
 # ---------------------------------------------------------------------------
 
 
+# ---------------------------------------------------------------------------
+# --record-trace=FILE, --replay-trace=FILE and --replay-speed=FACTOR, anything else is a file to flash
+def parse_options(config, args):
+    filenames = []
+    for arg in args:
+        option, _, value = arg.partition("=")
+        if option == "--record-trace":
+            config.record_trace = value
+        elif option == "--replay-trace":
+            config.replay_trace = value
+        elif option == "--replay-speed":
+            try:
+                config.replay_speed = float(value)
+            except ValueError:
+                raise ValueError("Invalid --replay-speed '{}', expected a factor like 1 or 0.5".format(value))
+        else:
+            filenames.append(arg)
+    return filenames
+
+
+# Flashes (typically replays a trace) without GUI, e.g. to benchmark or regression-test FlashingThread:
+#   nodemcu-pyflasher.py --headless --replay-trace=session.trace --replay-speed=0 firmware.bin
+# Returns the exit code, non-zero if flashing failed or the replay diverged from the trace.
+def run_headless(args):
+    config = FlashConfig()
+    try:
+        filenames = parse_options(config, args)
+        if len(filenames) != 1:
+            raise ValueError("Expected exactly one firmware file")
+        config.firmware_path = filenames[0]
+        if FirmwareArchive.is_archive(config.firmware_path):
+            config.archive = FirmwareArchive(config.firmware_path)
+    except (IOError, ValueError, tarfile.TarError, zipfile.BadZipFile) as e:
+        print(e)
+        return 2
+
+    outcome = {}
+    worker = FlashingThread(None, config, lambda stats, error: outcome.update(error=error))
+    worker.start()
+    worker.join()
+    if outcome.get("error") is not None:
+        print("Flash failed: %s" % outcome["error"])
+        return 1
+    return 0
+
+# ---------------------------------------------------------------------------
+
+
 # ---------------------------------------------------------------------------
 class MyFileDropTarget(wx.FileDropTarget):
     def __init__(self, onDrop):
@@ -136,21 +1534,41 @@ class MyFileDropTarget(wx.FileDropTarget):
 class NodeMcuFlasher(wx.Frame):
 
     def __init__(self, parent, title):
-        wx.Frame.__init__(self, parent, -1, title, size=(450, 190),
+        # room for the OTA, transfer and (up to four lines of) statistics rows above the console
+        wx.Frame.__init__(self, parent, -1, title, size=(520, 600),
                           style=wx.DEFAULT_FRAME_STYLE | wx.NO_FULL_REPAINT_ON_RESIZE)
-        self.SetMinSize(size=(450, 190))
+        self.SetMinSize(size=(450, 440))
         self._config = FlashConfig()
+        self._config.metrics = FlashMetrics()
+        self._config.profiles = DeviceProfiles()
+        self._log = SessionLog(os.path.join(_user_data_dir(), "logs"))
+        self._scheduler = None
+        self._ota_http_server = None
 
         self._set_icons()
         self._init_ui()
 
-        sys.stdout = RedirectText(self.console_ctrl)
+        sys.stdout = RedirectText(self.console_ctrl, self._log)
+        self.Bind(wx.EVT_CLOSE, self._on_close)
+
+        try:
+            MetricsHTTPServer(self._config.metrics)
+        except OSError as e:
+            print("Metrics endpoint on port %d unavailable: %s\n" % (__metrics_port__, e))
+        self._stats_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self._update_stats, self._stats_timer)
+        self._stats_timer.Start(2000)
 
         file_drop_target = MyFileDropTarget(self.set_filepath)
         self.SetDropTarget(file_drop_target)
 
-        if len(sys.argv) > 1:
-            filenames = sys.argv[1:]
+        try:
+            filenames = parse_options(self._config, sys.argv[1:])
+        except ValueError as e:
+            filenames = []
+            r = threading.Timer(0, self.report_error, [str(e)])
+            r.start()
+        if filenames:
             self.set_filepath(filenames)
 
         self.Centre(wx.BOTH)
@@ -166,9 +1584,35 @@ class NodeMcuFlasher(wx.Frame):
         def on_clicked(event):
             if self._config.firmware_path != None:
                 self.console_ctrl.SetValue("")
+                self._log.start_session("Flashing %s" % self._config.firmware_path)
                 worker = FlashingThread(self, self._config)
                 worker.start()
 
+        def on_flash_all(event):
+            if self._config.firmware_path is None:
+                return
+            if self._scheduler is None:
+                self._scheduler = FlashScheduler(self, self._config)
+            for port_info in sorted(list_ports.comports()):
+                if port_info.vid is not None:
+                    self._scheduler.submit(port_info.device, usb_hub(port_info))
+
+        def on_push_ota(event):
+            targets = self.ota_targets.GetValue().replace(",", " ").split()
+            if self._config.firmware_path is None or not targets:
+                return
+            try:
+                if self._ota_http_server is None:
+                    self._ota_http_server = FirmwareHTTPServer()
+            except OSError as e:
+                self.report_error("Cannot serve firmware on port %d\n\n%s" % (__ota_http_port__, e))
+                return
+            OtaThread(self._ota_http_server, self._config, targets, self.ota_password.GetValue() or None).start()
+
+        def on_new_shift(event):
+            self._config.metrics.reset()
+            self._update_stats(event)
+
         def on_select_port(event):
             choice = event.GetEventObject()
             self._config.port = choice.GetString(choice.GetSelection())
@@ -177,11 +1621,14 @@ class NodeMcuFlasher(wx.Frame):
             filepath = event.GetPath().replace("'", "")
             self.set_filepath([filepath])
 
+        def on_auto_tune(event):
+            self._config.auto_tune = event.IsChecked()
+
         panel = wx.Panel(self)
 
         hbox = wx.BoxSizer(wx.HORIZONTAL)
 
-        fgs = wx.FlexGridSizer(4, 2, 10, 10)
+        fgs = wx.FlexGridSizer(7, 2, 10, 10)
 
         self.choice = wx.Choice(panel, choices=self._get_serial_ports())
         self.choice.Bind(wx.EVT_CHOICE, on_select_port)
@@ -191,6 +1638,10 @@ class NodeMcuFlasher(wx.Frame):
         reload_button.Bind(wx.EVT_BUTTON, on_reload)
         reload_button.SetToolTip("Reload serial device list")
 
+        flash_all_button = wx.Button(panel, label="Flash all")
+        flash_all_button.Bind(wx.EVT_BUTTON, on_flash_all)
+        flash_all_button.SetToolTip("Flash every connected USB serial device, as many at once as their hubs handle")
+
         self.filepath_text = wx.TextCtrl(panel, style=wx.TE_READONLY)
 
         self.file_picker = wx.FilePickerCtrl(panel, style=wx.FLP_OPEN|wx.FLP_FILE_MUST_EXIST)
@@ -200,6 +1651,7 @@ class NodeMcuFlasher(wx.Frame):
         serial_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
         serial_boxsizer.Add(self.choice, 1, wx.EXPAND)
         serial_boxsizer.Add(reload_button, flag=wx.LEFT, border=5)
+        serial_boxsizer.Add(flash_all_button, flag=wx.LEFT, border=5)
 
         file_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
         file_boxsizer.Add(self.filepath_text, 1, wx.EXPAND)
@@ -212,6 +1664,37 @@ class NodeMcuFlasher(wx.Frame):
         self.button.SetForegroundColour(wx.Colour("RED"))
         # self.button.Disable()
 
+        self.ota_targets = wx.TextCtrl(panel)
+        self.ota_targets.SetHint("host[:port], ...")
+        self.ota_targets.SetToolTip("Devices running ArduinoOTA to push the firmware to over the network")
+        self.ota_password = wx.TextCtrl(panel, style=wx.TE_PASSWORD, size=wx.Size(100, -1))
+        self.ota_password.SetHint("Password")
+
+        ota_button = wx.Button(panel, label="Push OTA")
+        ota_button.Bind(wx.EVT_BUTTON, on_push_ota)
+
+        ota_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+        ota_boxsizer.Add(self.ota_targets, 1, wx.EXPAND)
+        ota_boxsizer.Add(self.ota_password, flag=wx.LEFT, border=5)
+        ota_boxsizer.Add(ota_button, flag=wx.LEFT, border=5)
+
+        auto_tune_checkbox = wx.CheckBox(panel, label="Auto-tune compression per port")
+        auto_tune_checkbox.SetValue(self._config.auto_tune)
+        auto_tune_checkbox.Bind(wx.EVT_CHECKBOX, on_auto_tune)
+        auto_tune_checkbox.SetToolTip("Learn link and decompression speed of each port and pick the faster transfer")
+
+        self.stats_text = wx.StaticText(panel)
+        self._stats_lines = 0
+        self.stats_text.SetFont(wx.Font((0, 11), wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
+
+        new_shift_button = wx.Button(panel, label="New shift")
+        new_shift_button.Bind(wx.EVT_BUTTON, on_new_shift)
+        new_shift_button.SetToolTip("Reset the statistics")
+
+        stats_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+        stats_boxsizer.Add(self.stats_text, 1, wx.EXPAND)
+        stats_boxsizer.Add(new_shift_button, flag=wx.LEFT | wx.ALIGN_TOP, border=5)
+
         self.console_ctrl = wx.TextCtrl(panel, style=wx.TE_MULTILINE | wx.TE_READONLY | wx.HSCROLL)
         self.console_ctrl.SetFont(wx.Font((0, 13), wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL,
                                           wx.FONTWEIGHT_NORMAL))
@@ -221,13 +1704,19 @@ class NodeMcuFlasher(wx.Frame):
 
         port_label = wx.StaticText(panel, label="Serial port")
         file_label = wx.StaticText(panel, label="Firmware")
+        ota_label = wx.StaticText(panel, label="OTA devices")
+        transfer_label = wx.StaticText(panel, label="Transfer")
+        stats_label = wx.StaticText(panel, label="Statistics")
         console_label = wx.StaticText(panel, label="Console")
 
         fgs.AddMany([file_label, (file_boxsizer, 1, wx.EXPAND),
                     (wx.StaticText(panel, label="")), (self.button, 1, wx.EXPAND),
                     port_label, (serial_boxsizer, 1, wx.EXPAND),
+                    ota_label, (ota_boxsizer, 1, wx.EXPAND),
+                    transfer_label, auto_tune_checkbox,
+                    stats_label, (stats_boxsizer, 1, wx.EXPAND),
                     (console_label, 1, wx.EXPAND), (self.console_ctrl, 1, wx.EXPAND)])
-        fgs.AddGrowableRow(3, 1)
+        fgs.AddGrowableRow(6, 1)
         fgs.AddGrowableCol(1, 1)
         hbox.Add(fgs, proportion=2, flag=wx.ALL | wx.EXPAND, border=15)
         panel.SetSizer(hbox)
@@ -247,6 +1736,34 @@ class NodeMcuFlasher(wx.Frame):
             ports.append(port + " - " + desc)
         return ports
 
+    def _update_stats(self, event):
+        def seconds(value):
+            return ">%ds" % FlashMetrics.BUCKETS[-2] if value == float("inf") else "%.1fs" % value
+
+        stats = self._config.metrics.snapshot()
+        boards_per_hour = "n/a" if stats["boards_per_hour"] is None else "%.1f" % stats["boards_per_hour"]
+        lines = ["%s boards/h, %d flashed, %d failed (%.1f%%), %.1f%% retries" % (
+            boards_per_hour, stats["flashed"], stats["failed"], stats["failure_rate"] * 100,
+            stats["retry_rate"] * 100)]
+        if stats["median"] is not None:
+            lines.append("Flash time median %s, p95 %s" % (seconds(stats["median"]), seconds(stats["p95"])))
+        if stats["failures"]:
+            lines.append("Failures: " + ", ".join("%s %d" % failure for failure in sorted(stats["failures"].items())))
+        if stats["port_rates"]:
+            lines.append("Throughput: " + ", ".join("%s %.1f kB/s" % (port, rate / 1000)
+                                                    for port, rate in sorted(stats["port_rates"].items())))
+        self.stats_text.SetLabel("\n".join(lines))
+        # the label grows and shrinks with the lines shown, the rows below have to move
+        if len(lines) != self._stats_lines:
+            self._stats_lines = len(lines)
+            self.stats_text.GetParent().Layout()
+
+    def _on_close(self, event):
+        self._stats_timer.Stop()
+        sys.stdout = sys.__stdout__
+        self._log.close()
+        event.Skip()
+
     def _set_icons(self):
         self.SetIcon(images.Icon.GetIcon())
 
@@ -254,6 +1771,7 @@ class NodeMcuFlasher(wx.Frame):
         dlg = wx.MessageDialog(None, message, caption=caption, style=wx.ICON_ERROR)
         dlg.ShowModal()
         self.console_ctrl.AppendText("\n" + message.replace("\n\n", "\n") + "\n\n")
+        self._log.write("\n%s: %s\n\n" % (caption, message.replace("\n\n", "\n")))
 
         if fromFlash:
             self.button.SetLabel("Try flash again")
@@ -261,8 +1779,24 @@ class NodeMcuFlasher(wx.Frame):
             self.button.Enable()
 
     def set_filepath(self, filenames):
-        msg = "Some thing error."
+        firmware = [filepath for filepath in filenames if not filepath.lower().endswith(".csv")]
         for filepath in filenames:
+            if filepath not in firmware and not self._set_provisioning(filepath):
+                return False
+        if not firmware:
+            return True
+
+        msg = "Some thing error."
+        for filepath in firmware:
+            if FirmwareArchive.is_archive(filepath):
+                try:
+                    self._config.archive = FirmwareArchive(filepath)
+                except (IOError, ValueError, tarfile.TarError, zipfile.BadZipFile) as err:
+                    msg = "Error opening archive '{}'\n\n{}".format(filepath, err)
+                    break
+                self._set_firmware(filepath)
+                return True
+
             magic = 0x00
             try:
                 firmware = open(filepath, 'rb')
@@ -277,19 +1811,34 @@ class NodeMcuFlasher(wx.Frame):
                 msg += "magic byte={:02X}, should be {:02X}".format(magic, esptool.ESPLoader.ESP_IMAGE_MAGIC)
                 break
 
-            self._config.firmware_path = filepath
-            self.file_picker.SetPath(filepath)
-            self.filepath_text.SetValue(filepath)
-            self.button.SetLabel("Flash ESP32")
-            self.button.SetForegroundColour(wx.Colour("FOREST GREEN"))
-            # self.button.Enable()
-            self.button.SetFocus()
+            self._config.archive = None
+            self._set_firmware(filepath)
             return True
 
         r = threading.Timer(0, self.report_error, [msg])
         r.start()
         return False
 
+    def _set_firmware(self, filepath):
+        self._config.firmware_path = filepath
+        self.file_picker.SetPath(filepath)
+        self.filepath_text.SetValue(filepath)
+        self.button.SetLabel("Flash ESP32")
+        self.button.SetForegroundColour(wx.Colour("FOREST GREEN"))
+        # self.button.Enable()
+        self.button.SetFocus()
+
+    def _set_provisioning(self, filepath):
+        try:
+            self._config.provisioning = Provisioning(filepath)
+        except (IOError, ValueError, KeyError, struct.error, csv.Error) as err:
+            msg = "Error reading device records '{}'\n\n{}".format(filepath, err)
+            r = threading.Timer(0, self.report_error, [msg])
+            r.start()
+            return False
+        print("Provisioning %d devices from %s\n" % (len(self._config.provisioning), filepath))
+        return True
+
 # ---------------------------------------------------------------------------
 
 # ----------------------------------------------------------------------------
@@ -306,6 +1855,8 @@ class App(wx.App, wx.lib.mixins.inspection.InspectionMixin):
 
 # ---------------------------------------------------------------------------
 def main():
+    if "--headless" in sys.argv[1:]:
+        sys.exit(run_headless([arg for arg in sys.argv[1:] if arg != "--headless"]))
     app = App(False)
     app.MainLoop()
 # ---------------------------------------------------------------------------
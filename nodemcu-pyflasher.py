@@ -1,4 +1,6 @@
 #!/usr/bin/env python
 
 import Main
-Main.main()
+
+if __name__ == '__main__':
+    Main.main()